@@ -24,64 +24,429 @@
 
 import argparse
 import subprocess
+import concurrent.futures
+import functools
+import queue
+import shlex
+import signal
+import threading
 import time
 import os
+import urllib.parse
 import requests
 import json
 import logging
 from pprint import pprint
+from requests.adapters import HTTPAdapter
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # watchdog is optional, only needed for --watch
+    FileSystemEventHandler = object
+    Observer = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder is the fallback
+    orjson = None
 
 # Configure basic logging
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+# Shared HTTP session so successive webhook posts reuse the keep-alive
+# connection instead of paying a fresh TCP/TLS handshake every time.
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+# Webhook posts are fire-and-forget, so they go to a background thread
+# instead of blocking the poll loop. A single worker keeps messages in order;
+# the semaphore caps how many can pile up behind a slow endpoint.
+_HOOK_EXEC = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+_HOOK_SLOTS = threading.BoundedSemaphore(32)
+
+# Set to cut the sleep between polls short (SIGHUP, ref watcher, SIGTERM);
+# _EXIT additionally asks monitor_repo to return.
+_WAKE = threading.Event()
+_EXIT = threading.Event()
+
+# Parsed packed-refs files: {path: (stat signature, {refname: sha})}
+_PACKED_REFS = {}
+
+
+def encode_payload(payload):
+    """Serialize a webhook payload to JSON bytes, using orjson when available"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload).encode()
+
 
 def send_webhook_message(webhook_url, payload):
-    """Send message to webhook (same implementation as before)"""
+    """Send message to webhook over the shared session"""
     headers = {"Content-Type": "application/json"}
 
     try:
-        response = requests.post(webhook_url, headers=headers, data=json.dumps(payload))
+        response = _SESSION.post(
+            webhook_url, headers=headers, data=encode_payload(payload), timeout=10
+        )
         response.raise_for_status()
-        logging.info(f"Message: {payload} sent successfully")
+        logging.info("Message sent successfully to %s", webhook_url)
         return True
     except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to send message: {e}")
+        logging.error("Failed to send message: %s", e)
         return False
 
 
+def webhook_message_done(future):
+    """Free the send slot and log anything send_webhook_message didn't catch"""
+    _HOOK_SLOTS.release()
+    error = None if future.cancelled() else future.exception()
+    if error is not None:
+        logging.error("Failed to send message: %r", error, exc_info=error)
+
+
+def post_webhook_message(webhook_url, payload):
+    """Queue a webhook message for sending in the background.
+
+    Blocks only when too many messages are already waiting to be sent.
+    """
+    _HOOK_SLOTS.acquire()
+    future = _HOOK_EXEC.submit(send_webhook_message, webhook_url, payload)
+    future.add_done_callback(webhook_message_done)
+    return future
+
+
 def git_checkout_branch(branch_name):
     """Checkout specified git branch"""
-    try:
-        subprocess.run(["git", "checkout", branch_name], check=True)
-        return True
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Failed to checkout branch {branch_name}: {e}")
+    result = subprocess.run(
+        ["git", "-c", "advice.detachedHead=false", "checkout", branch_name]
+    )
+    if result.returncode != 0:
+        logging.error(
+            "Failed to checkout branch %s: exit status %d",
+            branch_name,
+            result.returncode,
+        )
         return False
+    return True
+
+
+def git_ref_exists(ref):
+    """Return True if the full refname ref exists"""
+    result = subprocess.run(["git", "show-ref", "--verify", "--quiet", ref])
+    return result.returncode == 0
+
+
+def git_checkout_commit(branch_name, commit_hash):
+    """Checkout a branch pinned to exactly commit_hash.
+
+    HEAD stays on the branch rather than detaching at the commit, so a sync
+    command like `git pull` keeps working on the next cycle. The branch is
+    reset to the commit, which follows force-pushes and never tests local
+    commits in place of the one we report. Names that are not branches
+    (SHAs, tags ...) are checked out detached.
+    """
+    is_local = git_ref_exists(f"refs/heads/{branch_name}")
+    is_remote = git_ref_exists(f"refs/remotes/origin/{branch_name}")
+    if not is_local and not is_remote:
+        return git_checkout_branch(commit_hash)
+
+    result = subprocess.run(["git", "checkout", "-B", branch_name, commit_hash])
+    if result.returncode != 0:
+        logging.error(
+            "Failed to checkout %s at %s: exit status %d",
+            branch_name,
+            commit_hash,
+            result.returncode,
+        )
+        return False
+    if not is_local:
+        # -B keeps an existing upstream but doesn't set one up like a plain
+        # checkout of a remote branch would
+        subprocess.run(
+            ["git", "branch", "--quiet", f"--set-upstream-to=origin/{branch_name}"]
+            + [branch_name]
+        )
+    return True
+
+
+def is_commit_sha(name):
+    """Return True if name is already a full 40-char SHA-1 object name"""
+    return len(name) == 40 and all(c in "0123456789abcdef" for c in name.lower())
+
+
+def find_git_dir(repo_dir):
+    """Return the directory holding repo_dir's refs, or None if unsure.
+
+    Follows the "gitdir: ..." file used by worktrees and submodules, and the
+    commondir link that points linked worktrees at the shared refs.
+    """
+    git_dir = os.path.join(repo_dir, ".git")
+    if os.path.isfile(git_dir):
+        with open(git_dir) as f:
+            content = f.read().strip()
+        if not content.startswith("gitdir:"):
+            return None
+        git_dir = os.path.join(repo_dir, content[len("gitdir:") :].strip())
+    elif not os.path.isdir(git_dir):
+        # Bare repository
+        git_dir = repo_dir
+    if not os.path.isfile(os.path.join(git_dir, "HEAD")):
+        return None
+
+    commondir = os.path.join(git_dir, "commondir")
+    if os.path.isfile(commondir):
+        with open(commondir) as f:
+            git_dir = os.path.join(git_dir, f.read().strip())
+    return os.path.abspath(git_dir)
+
+
+def read_packed_refs(git_dir):
+    """Return {refname: sha} from packed-refs, reparsed only when it changes"""
+    path = os.path.join(git_dir, "packed-refs")
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return {}
+    signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+    cached = _PACKED_REFS.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+
+    refs = {}
+    with open(path) as f:
+        for line in f:
+            # Skip the header and peeled "^<sha>" lines of annotated tags
+            if line.startswith(("#", "^")):
+                continue
+            sha, _, refname = line.rstrip("\n").partition(" ")
+            refs[refname] = sha
+    _PACKED_REFS[path] = (signature, refs)
+    return refs
+
+
+def fast_ref_sha(git_dir, ref):
+    """Read a ref's commit hash from disk without running git.
+
+    A loose ref file wins over its packed-refs entry, as in git itself.
+    Returns None for anything unusual (symbolic refs, reftable, ...), in
+    which case the caller should ask git.
+    """
+    try:
+        with open(os.path.join(git_dir, ref)) as f:
+            sha = f.readline().strip()
+    except FileNotFoundError:
+        sha = read_packed_refs(git_dir).get(ref)
+    except OSError:
+        return None
+    return sha if sha and is_commit_sha(sha) else None
+
+
+def prepare_worktree(worktree_dir, branch_name, commit_hash):
+    """Check a commit out in the branch's own worktree and return its path.
 
+    The worktree is created on first use and reused afterwards, so moving
+    between branches never rewrites the main working tree and each branch
+    keeps its build artifacts. Returns None on failure.
+    """
+    # Percent-encode the whole name so "a/b" and "a_b" get distinct dirs
+    path = os.path.join(worktree_dir, urllib.parse.quote(branch_name, safe=""))
+    listing = subprocess.run(
+        ["git", "worktree", "list", "--porcelain"], stdout=subprocess.PIPE, text=True
+    )
+    if f"worktree {path}\n" in listing.stdout:
+        command = ["git", "-C", path, "reset", "--hard", "--quiet", commit_hash]
+    elif os.path.exists(path):
+        logging.error("%s exists but is not a worktree of this repo", path)
+        return None
+    else:
+        # Forget worktrees whose directories were removed behind our back
+        subprocess.run(["git", "worktree", "prune"])
+        command = ["git", "worktree", "add", "--detach", path, commit_hash]
+
+    result = subprocess.run(command)
+    if result.returncode != 0:
+        logging.error(
+            "Failed to update worktree %s for %s: exit status %d",
+            path,
+            branch_name,
+            result.returncode,
+        )
+        return None
+    return path
 
-def get_branch_commit_hash(branch_name):
+
+def get_branch_commit_hash(branch_name, prefer_local=False):
     """Return the latest commit hash for a given branch name.
 
-    Tries several references (local branch, origin/branch, direct name) to be robust.
+    Tries several references (origin/branch, local branch, direct name) to be robust.
+    The remote-tracking ref comes first since that is what a fetch moves;
+    with prefer_local the local branch does, for sync commands that move it.
     Returns None if the branch cannot be resolved.
     """
-    candidates = [f"refs/heads/{branch_name}", f"origin/{branch_name}", branch_name]
-    for ref in candidates:
-        try:
-            result = subprocess.run(
-                ["git", "rev-parse", "--verify", ref],
-                check=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
+    return get_branch_commit_hashes([branch_name], prefer_local)[branch_name]
+
+
+def get_branch_commit_hashes(branches, prefer_local=False):
+    """Resolve many branches at once, like get_branch_commit_hash.
+
+    Origin/local refs are read straight from the ref files under .git when
+    possible. Whatever is left is looked up with a single git for-each-ref
+    call, and only branches it can't find fall back to a git rev-parse of
+    their own. Returns {branch: commit_hash or None}.
+    """
+    git_dir = find_git_dir(".")
+    hashes = dict.fromkeys(branches)
+    candidates = {}
+    for branch in branches:
+        refs = [f"refs/remotes/origin/{branch}", f"refs/heads/{branch}"]
+        if prefer_local:
+            refs.reverse()
+        # A full SHA names a fixed commit, nothing to look up
+        if is_commit_sha(branch):
+            hashes[branch] = branch.lower()
+            continue
+        if git_dir:
+            hashes[branch] = next(
+                filter(None, (fast_ref_sha(git_dir, ref) for ref in refs)), None
             )
-            return result.stdout.strip()
-        except subprocess.CalledProcessError:
+        if not hashes[branch]:
+            candidates[branch] = refs
+
+    # Patterns also match by prefix, so keep only exact refname hits
+    found = {}
+    if candidates:
+        result = subprocess.run(
+            ["git", "for-each-ref", "--format=%(refname) %(objectname)"]
+            + [ref for refs in candidates.values() for ref in refs],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if result.returncode == 0:
+            found = dict(line.split(" ", 1) for line in result.stdout.splitlines())
+
+    for branch, refs in candidates.items():
+        hashes[branch] = next((found[ref] for ref in refs if ref in found), None)
+        if hashes[branch]:
             continue
-    logging.error(f"Could not resolve branch '{branch_name}' to a commit hash")
-    return None
+
+        # Fall back to a direct name (tag, SHA, other remote ...)
+        result = subprocess.run(
+            ["git", "rev-parse", "--verify", branch],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        if result.returncode == 0:
+            hashes[branch] = result.stdout.strip()
+        else:
+            logging.error("Could not resolve branch '%s' to a commit hash", branch)
+    return hashes
+
+
+def fetch_branch(branch_name):
+    """Fetch a branch into refs/remotes/origin without touching the working tree"""
+    result = subprocess.run(
+        # Skip FETCH_HEAD so parallel fetches don't trample each other
+        ["git", "-c", "fetch.writeFetchHead=false", "fetch", "--no-tags"]
+        + ["--quiet", "origin", branch_name],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if result.returncode != 0:
+        logging.error(
+            "Failed to fetch %s from origin: %s", branch_name, result.stderr.strip()
+        )
+        return False
+    return True
+
+
+def get_remote_tips(branches):
+    """Ask origin for the tips of branches with a single git ls-remote.
+
+    Returns {branch: sha} for the branches origin has, or None if origin
+    could not be asked.
+    """
+    result = subprocess.run(
+        ["git", "ls-remote", "--heads", "origin"] + branches,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if result.returncode != 0:
+        logging.warning("git ls-remote origin failed: %s", result.stderr.strip())
+        return None
+
+    tips = {}
+    for line in result.stdout.splitlines():
+        sha, _, ref = line.partition("\t")
+        if ref.startswith("refs/heads/"):
+            tips[ref[len("refs/heads/") :]] = sha
+    return tips
+
+
+def find_moved_branches(branches, last_commit):
+    """Return the branches origin may have moved since we last tested them.
+
+    An ls-remote is much cheaper than a fetch, so idle cycles can skip
+    fetching altogether. Branches origin doesn't have are left out, as there
+    is nothing to fetch; if origin can't be asked at all, every branch
+    counts as moved so its fetch still runs.
+    """
+    branches = [b for b in branches if not is_commit_sha(b)]
+    if not branches:
+        return []
+    tips = get_remote_tips(branches)
+    if tips is None:
+        return branches
+    return [b for b in branches if b in tips and tips[b] != last_commit.get(b)]
+
+
+def resolve_branch_commits(branches, fetch_branches=(), prefer_local=False):
+    """Fetch the given branches concurrently, then resolve all heads in one call.
+
+    Only fetches and ref lookups run here, so the working tree is never
+    touched and the fetches can safely overlap. Returns
+    {branch: commit_hash or None}.
+    """
+    if fetch_branches:
+        max_workers = min(8, len(fetch_branches))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(fetch_branch, fetch_branches))
+    return get_branch_commit_hashes(branches, prefer_local)
+
+
+def sync_remote(sync_command, shell=False):
+    """Run the sync command in the current working tree, if one is configured
+
+    sync_command is an argv list, or a string for /bin/sh when shell is True.
+    """
+    if not sync_command:
+        return True
+    try:
+        result = subprocess.run(sync_command, shell=shell)
+    except OSError as e:
+        logging.error("Failed to fetch updates: %s", e)
+        return False
+    if result.returncode != 0:
+        logging.error("Failed to fetch updates: exit status %d", result.returncode)
+        return False
+    return True
+
+
+def sync_branch(branch_name, sync_command, shell=False):
+    """Checkout a branch and run the sync command on it.
+
+    Commands like `git pull` only update the checked-out branch, so each
+    branch needs its own run.
+    """
+    return git_checkout_branch(branch_name) and sync_remote(sync_command, shell)
 
 
 def get_latest_commit_hash():
@@ -92,81 +457,206 @@ def get_latest_commit_hash():
         )
         return result.stdout.strip()
     except subprocess.CalledProcessError as e:
-        logging.error(f"Failed to get commit hash: {e}")
+        logging.error("Failed to get commit hash: %s", e)
         return None
 
 
-def run_tests(test_script):
-    """Run test script and return exit code"""
+def log_test_output(stream):
+    """Forward test script output to the log line by line"""
+    for line in stream:
+        logging.info("[test] %s", line.rstrip("\n"))
+
+
+def kill_process_group(process):
+    """Kill a process started with start_new_session, and its children"""
+    if hasattr(os, "killpg"):
+        os.killpg(process.pid, signal.SIGKILL)
+    else:
+        process.kill()
+    return process.wait()
+
+
+def run_tests(test_script, timeout=None, worktree_path=None):
+    """Run test script and return exit code
+
+    The script runs in worktree_path if given, else the current directory.
+    Output is streamed into the log as it is produced. If the script is still
+    running after timeout seconds, its whole process group is killed and 124
+    is returned, like timeout(1). It is likewise killed as soon as an exit is
+    requested.
+    """
     try:
-        result = subprocess.run([test_script])
-        return result.returncode
-    except subprocess.CalledProcessError as e:
-        logging.error(f"Tests failed: {e}")
-        return 1
+        process = subprocess.Popen(
+            [test_script],
+            cwd=worktree_path,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            start_new_session=True,
+        )
     except FileNotFoundError:
-        logging.error(f"Test script not found: {test_script}")
+        logging.error("Test script not found: %s", test_script)
         exit(1)
 
+    reader = threading.Thread(
+        target=log_test_output, args=(process.stdout,), daemon=True
+    )
+    reader.start()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    returncode = None
+    # Wait in short slices so a SIGTERM doesn't have to outlast the tests
+    while returncode is None:
+        try:
+            returncode = process.wait(timeout=0.5)
+        except subprocess.TimeoutExpired:
+            if _EXIT.is_set():
+                logging.warning("Exit requested, killing tests")
+                returncode = kill_process_group(process)
+            elif deadline is not None and time.monotonic() >= deadline:
+                logging.error("Tests timed out after %s seconds, killing", timeout)
+                kill_process_group(process)
+                returncode = 124
+    # Don't hang on a grandchild that detached but kept the pipe open
+    reader.join(timeout=5)
+    return returncode
+
+
+class GitCatFile:
+    """Long-lived `git cat-file --batch` process for reading commit objects.
+
+    Each lookup is a stdin write plus a stdout read instead of a fresh git
+    process. Not thread-safe; use it from the monitor thread only. git exits
+    on its own once our end of the pipe is closed.
+    """
+
+    def __init__(self, cwd=None):
+        self.cwd = cwd
+        self.process = None
+        self._start()
+
+    def _start(self):
+        """(Re)start the cat-file process, dropping any previous one"""
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+        self.process = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self.cwd,
+        )
+
+    def one(self, sha):
+        """Return (full_sha, raw_body) for an object, or None if it is missing"""
+        try:
+            return self._query(sha)
+        except (OSError, EOFError) as e:
+            # git went away under us; a fresh process gets one more try
+            logging.warning("git cat-file died, restarting it: %s", e)
+            self._start()
+            return self._query(sha)
+
+    def _query(self, sha):
+        self.process.stdin.write(f"{sha}\n".encode())
+        self.process.stdin.flush()
+        # Header is "<sha> <type> <size>", or "<input> missing" on a miss
+        line = self.process.stdout.readline()
+        if not line:
+            raise EOFError("git cat-file exited")
+        header = line.decode().split()
+        if len(header) != 3:
+            return None
+        body = self.process.stdout.read(int(header[2]) + 1)
+        if len(body) != int(header[2]) + 1:
+            raise EOFError("git cat-file exited mid-object")
+        return header[0], body[:-1].decode(errors="replace")
+
+    def log(self, sha):
+        """Format a single commit like `git log -1 --format=%H%n%s%n%an`"""
+        found = self.one(sha)
+        if not found:
+            return None
+        full_sha, body = found
+        headers, _, message = body.partition("\n\n")
+        author = ""
+        for line in headers.splitlines():
+            if line.startswith("author "):
+                author = line[len("author ") :].rsplit(" <", 1)[0]
+                break
+        subject = " ".join(message.split("\n\n", 1)[0].split())
+        return f"{full_sha}\n{subject}\n{author}"
+
+
+@functools.lru_cache(maxsize=512)
+def read_commit_log(commit_hash_begin, commit_hash_end=0):
+    """Run git log for a commit or a range of commits.
+
+    Both endpoints are SHAs, so the output never changes and is cached.
+    Raises CalledProcessError on failure, which keeps errors out of the cache.
+    """
+    if commit_hash_end != 0:
+        revisions = [f"{commit_hash_begin}..{commit_hash_end}"]
+    else:
+        revisions = ["-1", f"{commit_hash_begin}"]
+    result = subprocess.run(
+        ["git", "--no-pager", "-c", "color.ui=never", "log", "--format=%H%n%s%n%an"]
+        + revisions,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+    commit_log = result.stdout.strip()
+    logging.info("Commit log: %s", commit_log)
+    return commit_log
+
 
-def get_commit_log(commit_hash_begin, commit_hash_end=0):
-    """Get commit log for a range of commits"""
+def get_commit_log(commit_hash_begin, commit_hash_end=0, cat_file=None):
+    """Get commit log for a range of commits
+
+    Single commits are read through cat_file when one is given; ranges still
+    need a real `git log`.
+    """
+    if cat_file and commit_hash_end == 0:
+        try:
+            commit_log = cat_file.log(commit_hash_begin)
+            if commit_log:
+                return commit_log
+        except (OSError, EOFError, ValueError) as e:
+            logging.error("git cat-file failed, falling back to git log: %s", e)
     try:
-        # Use subprocess to call Git command to get commit log
-        if commit_hash_end != 0:
-            result = subprocess.run(
-                [
-                    "git",
-                    "log",
-                    f"{commit_hash_begin}..{commit_hash_end}",
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=True,
-                text=True,
-            )
-        else:
-            result = subprocess.run(
-                [
-                    "git",
-                    "log",
-                    "-1",
-                    f"{commit_hash_begin}",
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                check=True,
-                text=True,
-            )
-        commit_log = result.stdout.strip()
-        logging.info(f"Commit log: {commit_log}")
+        return read_commit_log(commit_hash_begin, commit_hash_end)
     except subprocess.CalledProcessError as e:
-        commit_log = f"Error fetching commit log for {commit_hash_begin}..{commit_hash_end}: {e.stderr.strip()}"
-    return commit_log
+        return f"Error fetching commit log for {commit_hash_begin}..{commit_hash_end}: {e.stderr.strip()}"
 
 
-def on_test_begin(webhook_url, branch, commit_hash):
+def on_test_begin(webhook_url, branch, commit_log):
     """Send begin message to webhook"""
     payload = {
         "title": "黑锅侠，出击!",
-        "content": f"分支: {branch}\n最新提交:\n{get_commit_log(commit_hash)}",
+        "content": f"分支: {branch}\n最新提交:\n{commit_log}",
     }
-    send_webhook_message(webhook_url, payload)
+    post_webhook_message(webhook_url, payload)
 
 
-def on_test_success(webhook_url, branch, commit_hash):
+def on_test_success(webhook_url, branch, commit_log):
     """Send success message to webhook"""
     payload = {
         "title": "叮铃铃~ 测试通过!",
-        "content": f"分支: {branch}\n最新提交:\n{get_commit_log(commit_hash)}",
+        "content": f"分支: {branch}\n最新提交:\n{commit_log}",
     }
-    send_webhook_message(webhook_url, payload)
+    post_webhook_message(webhook_url, payload)
 
 
-def on_test_failure(webhook_url, branch, commit_hash, last_test_pass_commit):
-    """Send failure message to webhook"""
+def on_test_failure(
+    webhook_url, branch, commit_hash, last_test_pass_commit, commit_log
+):
+    """Send failure message to webhook
 
-    commit_log = get_commit_log(commit_hash)
+    commit_log covers just commit_hash; with a known good commit the whole
+    range since then is reported instead.
+    """
     if last_test_pass_commit:
         commit_log = get_commit_log(last_test_pass_commit, commit_hash)
 
@@ -174,7 +664,136 @@ def on_test_failure(webhook_url, branch, commit_hash, last_test_pass_commit):
         "title": "铛铛铛! 测试失败!",
         "content": f"分支: {branch}\n怀疑对象:\n{commit_log}",
     }
-    send_webhook_message(webhook_url, payload)
+    post_webhook_message(webhook_url, payload)
+
+
+class RefChangeHandler(FileSystemEventHandler):
+    """Queue the monitored branches whose ref files change under .git"""
+
+    def __init__(self, git_dir, branches, branch_queue):
+        super().__init__()
+        self.git_dir = git_dir
+        self.branches = set(branches)
+        self.branch_queue = branch_queue
+
+    def on_any_event(self, event):
+        # Opened/closed events fire on our own reads and would loop forever
+        if event.is_directory or event.event_type not in (
+            "created",
+            "modified",
+            "moved",
+        ):
+            return
+        # git updates refs by renaming "<ref>.lock" over "<ref>"
+        path = getattr(event, "dest_path", "") or event.src_path
+        ref = os.path.relpath(path, self.git_dir).replace(os.sep, "/")
+        if ref == "packed-refs":
+            # Packed refs hold every branch, so we can't tell which one moved
+            for branch in self.branches:
+                self.branch_queue.put(branch)
+            _WAKE.set()
+            return
+        for prefix in ("refs/heads/", "refs/remotes/origin/"):
+            if ref.startswith(prefix) and ref[len(prefix) :] in self.branches:
+                self.branch_queue.put(ref[len(prefix) :])
+                _WAKE.set()
+
+
+def start_ref_watcher(branches, branch_queue):
+    """Watch .git refs and queue branches whose head changes.
+
+    Returns the running observer, or None when watching is not possible and
+    the caller should fall back to plain polling.
+    """
+    if Observer is None:
+        logging.warning("watchdog is not installed, falling back to polling")
+        return None
+    git_dir = find_git_dir(".")
+    if git_dir is None:
+        logging.warning("Cannot locate the git directory, falling back to polling")
+        return None
+
+    handler = RefChangeHandler(git_dir, branches, branch_queue)
+    observer = Observer()
+    observer.schedule(handler, git_dir, recursive=False)
+    observer.schedule(handler, os.path.join(git_dir, "refs"), recursive=True)
+    observer.start()
+    logging.info("Watching %s for ref changes", git_dir)
+    return observer
+
+
+def drain_branch_queue(branch_queue):
+    """Return every branch queued by the ref watcher so far.
+
+    A single ref update fires several events, so duplicates are collapsed.
+    """
+    pending = set()
+    while True:
+        try:
+            pending.add(branch_queue.get_nowait())
+        except queue.Empty:
+            return pending
+
+
+def wait_for_wake(deadline):
+    """Sleep until deadline unless woken first. Returns True if woken early."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0 or not _WAKE.wait(timeout=remaining):
+        return False
+    _WAKE.clear()
+    return not _EXIT.is_set()
+
+
+def request_exit(signum=None, frame=None):
+    """Signal handler: stop monitoring after the current step"""
+    _EXIT.set()
+    _WAKE.set()
+
+
+def check_branch(
+    args, branch, current_commit, last_commit, last_test_pass_commit, cat_file=None
+):
+    """Checkout and test a branch if its head moved since we last saw it"""
+    if not current_commit:
+        logging.error("Skipping tests for %s because branch can't be resolved", branch)
+        return
+
+    # Check for new commits
+    if current_commit == last_commit.get(branch):
+        return
+
+    # Test the exact commit we resolved: the local branch may lag behind
+    # origin since we only fetch
+    worktree_path = None
+    if getattr(args, "worktree_dir", None):
+        worktree_path = prepare_worktree(args.worktree_dir, branch, current_commit)
+        if not worktree_path:
+            logging.error("Skipping tests for %s because checkout failed", branch)
+            return
+    elif not git_checkout_commit(branch, current_commit):
+        logging.error("Skipping tests for %s because checkout failed", branch)
+        return
+
+    logging.info("New commit detected: %s", current_commit)
+    # Same log for the begin and success messages, so fetch it once
+    commit_log = get_commit_log(current_commit, cat_file=cat_file)
+    on_test_begin(args.url, branch, commit_log)
+
+    timeout = getattr(args, "test_timeout_sec", None)
+    returncode = run_tests(args.test_script, timeout, worktree_path=worktree_path)
+    if _EXIT.is_set():
+        # Killed on the way out; not a real result, retest on the next start
+        logging.info("Tests for %s interrupted by exit request", branch)
+        return
+    if returncode == 0:
+        on_test_success(args.url, branch, commit_log)
+        last_test_pass_commit[branch] = current_commit
+    else:
+        on_test_failure(
+            args.url, branch, current_commit, last_test_pass_commit[branch], commit_log
+        )
+
+    last_commit[branch] = current_commit
 
 
 def monitor_repo(args):
@@ -182,9 +801,13 @@ def monitor_repo(args):
 
     Supports monitoring multiple branches (comma-separated via --branch).
     For each branch we track the last seen commit and last commit that passed tests.
-    When a branch changes we checkout that branch, run tests, and send webhook messages
-    that include the branch name.
+    Branch heads are polled concurrently without touching the working tree; only
+    when a branch changes do we checkout that branch, run tests, and send webhook
+    messages that include the branch name.
     """
+    # Relative to where we were started, not to --dir
+    if getattr(args, "worktree_dir", None):
+        args.worktree_dir = os.path.realpath(args.worktree_dir)
     os.chdir(args.dir)
 
     # Determine branches to monitor
@@ -203,54 +826,99 @@ def monitor_repo(args):
             )
             branches = [result.stdout.strip()]
         except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to determine current branch: {e}")
+            logging.error("Failed to determine current branch: %s", e)
             return False
 
-    logging.info(f"Monitoring branches: {branches}")
+    logging.info("Monitoring branches: %s", branches)
 
     # Initialize per-branch trackers
     last_commit = {b: None for b in branches}
     last_test_pass_commit = {b: None for b in branches}
 
-    while True:
-        for branch in branches:
-            # Checkout the branch first
-            if not git_checkout_branch(branch):
-                logging.error(f"Skipping tests for {branch} because checkout failed")
-                continue
-
-            # Sync updates from remote if command provided
-            if args.sync_command:
-                try:
-                    subprocess.run(args.sync_command, check=True, shell=True)
-                except subprocess.CalledProcessError as e:
-                    logging.error(f"Failed to fetch updates: {e}")
-                    continue
-
-            # Get current commit hash for this branch
-            current_commit = get_branch_commit_hash(branch)
-            if not current_commit:
-                logging.error(
-                    f"Skipping tests for {branch} because branch can't be resolved"
-                )
-                continue
-
-            # Check for new commits
-            if current_commit != last_commit.get(branch):
-                logging.info(f"New commit detected: {current_commit}")
-                on_test_begin(args.url, branch, current_commit)
+    # Without a sync command, fetch the monitored branches from origin ourselves
+    remotes = subprocess.run(["git", "remote"], stdout=subprocess.PIPE, text=True)
+    fetch = not args.sync_command and "origin" in remotes.stdout.split()
+    # Our fetches move origin's refs; a sync command moves the local branch,
+    # maybe from elsewhere, leaving refs/remotes/origin stale
+    prefer_local = not fetch
+
+    # main() already split the sync command into argv, unless --sync-shell
+    # asked for the old /bin/sh behaviour
+    sync_shell = getattr(args, "sync_shell", False)
+    sync_command = args.sync_command
+
+    # One persistent cat-file process serves every single-commit log lookup;
+    # we already chdir'd into --dir, so it runs there too
+    cat_file = GitCatFile()
+
+    # With --watch, ref changes under .git wake us up between polls
+    branch_queue = queue.Queue()
+    observer = None
+    if getattr(args, "watch", False):
+        # Keep our own git calls from taking locks the user's git may need
+        os.environ.setdefault("GIT_OPTIONAL_LOCKS", "0")
+        observer = start_ref_watcher(branches, branch_queue)
+
+    while not _EXIT.is_set():
+        # When fetching ourselves, one ls-remote tells us which branches
+        # origin moved and only those get fetched, leaving the working tree
+        # alone. A sync command may pull from anywhere, so origin can't vouch
+        # for it: it runs on every branch, checked out in turn.
+        moved = []
+        if fetch:
+            moved = find_moved_branches(branches, last_commit)
+        elif args.sync_command:
+            moved = [b for b in branches if not is_commit_sha(b)]
+
+        failed = set()
+        if args.sync_command:
+            for branch in moved:
+                if _EXIT.is_set():
+                    break
+                if not sync_branch(branch, sync_command, shell=sync_shell):
+                    failed.add(branch)
+
+        current_commits = resolve_branch_commits(
+            [b for b in branches if b not in failed],
+            moved if fetch else [],
+            prefer_local=prefer_local,
+        )
 
-                if run_tests(args.test_script) == 0:
-                    on_test_success(args.url, branch, current_commit)
-                    last_test_pass_commit[branch] = current_commit
-                else:
-                    on_test_failure(
-                        args.url, branch, current_commit, last_test_pass_commit[branch]
-                    )
+        for branch, current_commit in current_commits.items():
+            if _EXIT.is_set():
+                break
+            check_branch(
+                args,
+                branch,
+                current_commit,
+                last_commit,
+                last_test_pass_commit,
+                cat_file,
+            )
 
-                last_commit[branch] = current_commit
+        # Sleep until the next poll, handling ref changes as they arrive. A
+        # wake-up with nothing queued (e.g. SIGHUP) triggers a full poll now.
+        deadline = time.monotonic() + args.sleep_seconds
+        while wait_for_wake(deadline):
+            pending = drain_branch_queue(branch_queue)
+            if not pending:
+                break
+            pending_commits = get_branch_commit_hashes(pending, prefer_local)
+            for branch, current_commit in pending_commits.items():
+                if _EXIT.is_set():
+                    break
+                check_branch(
+                    args,
+                    branch,
+                    current_commit,
+                    last_commit,
+                    last_test_pass_commit,
+                    cat_file,
+                )
 
-        time.sleep(args.interval_minutes * 60 + args.interval_hours * 60 * 60)
+    if observer is not None:
+        observer.stop()
+        observer.join()
 
 
 def main():
@@ -280,14 +948,59 @@ def main():
         required=True,
         help="Test script to run",
     )
+    parser.add_argument(
+        "--worktree-dir",
+        help="Give each branch its own git worktree under this directory and run tests there, instead of checking branches out in --dir (not with --sync-command)",
+    )
+    parser.add_argument(
+        "--test-timeout-sec",
+        type=float,
+        help="Kill the test script and report a failure after this many seconds (default: no timeout)",
+    )
     parser.add_argument(
         "--sync-command",
-        help="Command to sync updates from remote",
+        help="Command to sync updates from remote, run every cycle with each branch checked out (default: fetch the branches git ls-remote origin shows moved)",
+    )
+    parser.add_argument(
+        "--sync-shell",
+        action="store_true",
+        help="Run --sync-command through /bin/sh (needed for pipes, &&, variables ...)",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="React to ref changes under .git immediately instead of waiting for the next poll (requires watchdog)",
     )
     args = parser.parse_args()
+    args.sleep_seconds = args.interval_minutes * 60.0 + args.interval_hours * 3600.0
+    if args.sleep_seconds <= 0:
+        parser.error("Set --interval-hours or --interval-minutes > 0")
+    if args.test_timeout_sec is not None and args.test_timeout_sec <= 0:
+        parser.error("--test-timeout-sec must be > 0")
+    if args.worktree_dir and args.sync_command:
+        # The sync would need each branch checked out in --dir, which is
+        # exactly what the detached per-branch worktrees avoid
+        parser.error("--worktree-dir cannot be combined with --sync-command")
+    # Parse the sync command once and exec it directly; --sync-shell keeps
+    # the old /bin/sh behaviour for commands that need pipes, && and such
+    if args.sync_command and not args.sync_shell:
+        try:
+            args.sync_command = shlex.split(args.sync_command)
+        except ValueError as e:
+            parser.error(f"Cannot parse --sync-command: {e}")
     pprint(args)
 
-    monitor_repo(args)
+    # SIGHUP polls immediately, SIGTERM stops without waiting out the sleep
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda *_: _WAKE.set())
+    signal.signal(signal.SIGTERM, request_exit)
+
+    try:
+        monitor_repo(args)
+    finally:
+        # Let queued webhook messages go out before closing the session
+        _HOOK_EXEC.shutdown(wait=True)
+        _SESSION.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,385 @@
+"""Tests for the git helpers in main_legacy.py."""
+
+import logging
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import pytest
+
+import main_legacy
+from main_legacy import (
+    GitCatFile,
+    RefChangeHandler,
+    drain_branch_queue,
+    fast_ref_sha,
+    find_git_dir,
+    find_moved_branches,
+    get_branch_commit_hashes,
+    get_remote_tips,
+    git_checkout_commit,
+    post_webhook_message,
+    prepare_worktree,
+    read_packed_refs,
+    run_tests,
+)
+
+SHA_A = "a" * 40
+SHA_B = "b" * 40
+SHA_C = "c" * 40
+
+
+def git(cwd, *args):
+    result = subprocess.run(
+        ["git", *args], cwd=cwd, check=True, capture_output=True, text=True
+    )
+    return result.stdout.strip()
+
+
+@pytest.fixture
+def git_repo(tmp_path):
+    """Create a temporary git repo with a multi-line subject commit."""
+    # Keep it in a subdirectory so clones and worktrees can sit beside it
+    repo = tmp_path / "repo"
+    repo.mkdir()
+    git(repo, "init")
+    git(repo, "config", "user.email", "test@test.com")
+    git(repo, "config", "user.name", "Test User")
+    (repo / "file.txt").write_text("hello\n")
+    git(repo, "add", ".")
+    git(repo, "commit", "-m", "first line\nsecond line\n\nbody text")
+    return repo
+
+
+def test_cat_file_log_matches_git_log(git_repo):
+    sha = git(git_repo, "rev-parse", "HEAD")
+    expected = git(git_repo, "log", "-1", "--format=%H%n%s%n%an", sha)
+    cat_file = GitCatFile(cwd=git_repo)
+    assert cat_file.log(sha) == expected
+    assert cat_file.log(sha[:10]) == expected
+
+
+def test_cat_file_log_missing_sha(git_repo):
+    cat_file = GitCatFile(cwd=git_repo)
+    assert cat_file.log("0" * 40) is None
+    # The process is still usable after a miss
+    sha = git(git_repo, "rev-parse", "HEAD")
+    assert cat_file.log(sha).startswith(sha)
+
+
+def test_cat_file_restarts_after_exit(git_repo):
+    sha = git(git_repo, "rev-parse", "HEAD")
+    cat_file = GitCatFile(cwd=git_repo)
+    cat_file.process.kill()
+    cat_file.process.wait()
+    assert cat_file.log(sha).startswith(sha)
+
+
+def test_checkout_commit_keeps_branch(git_repo, monkeypatch):
+    branch = git(git_repo, "rev-parse", "--abbrev-ref", "HEAD")
+    old = git(git_repo, "rev-parse", "HEAD")
+    (git_repo / "file.txt").write_text("hello world\n")
+    git(git_repo, "commit", "-am", "update file")
+    new = git(git_repo, "rev-parse", "HEAD")
+    git(git_repo, "reset", "--hard", "--quiet", old)
+
+    monkeypatch.chdir(git_repo)
+    assert git_checkout_commit(branch, new)
+    assert git(git_repo, "rev-parse", "--abbrev-ref", "HEAD") == branch
+    assert git(git_repo, "rev-parse", "HEAD") == new
+
+
+def test_checkout_commit_pins_diverged_branch(git_repo, monkeypatch):
+    # Local commits, or a force-push upstream, can't block the checkout
+    branch = git(git_repo, "rev-parse", "--abbrev-ref", "HEAD")
+    old = git(git_repo, "rev-parse", "HEAD")
+    git(git_repo, "commit", "--allow-empty", "-m", "local only")
+
+    monkeypatch.chdir(git_repo)
+    assert git_checkout_commit(branch, old)
+    assert git(git_repo, "rev-parse", "--abbrev-ref", "HEAD") == branch
+    assert git(git_repo, "rev-parse", "HEAD") == old
+
+
+def test_checkout_commit_detaches_for_non_branches(git_repo, monkeypatch):
+    head = git(git_repo, "rev-parse", "HEAD")
+    monkeypatch.chdir(git_repo)
+    assert git_checkout_commit(head, head)
+    assert git(git_repo, "rev-parse", "--abbrev-ref", "HEAD") == "HEAD"
+
+
+@pytest.fixture
+def fake_git_dir(tmp_path):
+    """Lay out a .git directory by hand, without running git."""
+    git_dir = tmp_path / ".git"
+    (git_dir / "refs" / "heads").mkdir(parents=True)
+    (git_dir / "refs" / "remotes" / "origin").mkdir(parents=True)
+    (git_dir / "HEAD").write_text("ref: refs/heads/main\n")
+    (git_dir / "packed-refs").write_text(
+        "# pack-refs with: peeled fully-peeled sorted\n"
+        f"{SHA_A} refs/heads/main\n"
+        f"{SHA_B} refs/tags/v1\n"
+        f"^{SHA_C}\n"
+    )
+    return git_dir
+
+
+def test_find_git_dir(tmp_path, fake_git_dir):
+    assert find_git_dir(str(tmp_path)) == str(fake_git_dir)
+
+
+def test_find_git_dir_not_a_repo(tmp_path):
+    assert find_git_dir(str(tmp_path)) is None
+
+
+def test_find_git_dir_follows_gitdir_and_commondir(tmp_path, fake_git_dir):
+    # Linked worktree: .git file -> .git/worktrees/wt, commondir -> ../..
+    wt_git_dir = fake_git_dir / "worktrees" / "wt"
+    wt_git_dir.mkdir(parents=True)
+    (wt_git_dir / "HEAD").write_text(f"{SHA_B}\n")
+    (wt_git_dir / "commondir").write_text("../..\n")
+    worktree = tmp_path / "wt"
+    worktree.mkdir()
+    (worktree / ".git").write_text(f"gitdir: {wt_git_dir}\n")
+    assert find_git_dir(str(worktree)) == str(fake_git_dir)
+
+
+def test_read_packed_refs_skips_header_and_peeled_lines(fake_git_dir):
+    refs = read_packed_refs(str(fake_git_dir))
+    assert refs == {"refs/heads/main": SHA_A, "refs/tags/v1": SHA_B}
+
+
+def test_read_packed_refs_reloads_on_change(fake_git_dir):
+    assert read_packed_refs(str(fake_git_dir))["refs/heads/main"] == SHA_A
+    packed = fake_git_dir / "packed-refs"
+    packed.write_text(f"{SHA_C} refs/heads/main\n{SHA_C} refs/heads/dev\n")
+    # Make sure the change shows even on coarse mtime filesystems
+    st = os.stat(packed)
+    os.utime(packed, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert read_packed_refs(str(fake_git_dir)) == {
+        "refs/heads/main": SHA_C,
+        "refs/heads/dev": SHA_C,
+    }
+
+
+def test_fast_ref_sha_prefers_loose_ref(fake_git_dir):
+    assert fast_ref_sha(str(fake_git_dir), "refs/heads/main") == SHA_A
+    (fake_git_dir / "refs" / "heads" / "main").write_text(f"{SHA_B}\n")
+    assert fast_ref_sha(str(fake_git_dir), "refs/heads/main") == SHA_B
+
+
+def test_fast_ref_sha_symbolic_ref(fake_git_dir):
+    (fake_git_dir / "refs" / "remotes" / "origin" / "HEAD").write_text(
+        "ref: refs/remotes/origin/main\n"
+    )
+    assert fast_ref_sha(str(fake_git_dir), "refs/remotes/origin/HEAD") is None
+
+
+def test_fast_ref_sha_missing_ref(fake_git_dir):
+    assert fast_ref_sha(str(fake_git_dir), "refs/heads/nope") is None
+
+
+@pytest.fixture
+def clone(git_repo, tmp_path):
+    """Clone git_repo, which also gets a feature/x branch, as origin."""
+    git(git_repo, "branch", "feature/x")
+    git(tmp_path, "clone", "--quiet", str(git_repo), "clone")
+    return tmp_path / "clone"
+
+
+def test_get_remote_tips(git_repo, clone, monkeypatch):
+    branch = git(git_repo, "rev-parse", "--abbrev-ref", "HEAD")
+    head = git(git_repo, "rev-parse", "HEAD")
+    monkeypatch.chdir(clone)
+    tips = get_remote_tips([branch, "feature/x", "nope"])
+    assert tips == {branch: head, "feature/x": head}
+
+
+def test_get_remote_tips_without_origin(git_repo, monkeypatch):
+    monkeypatch.chdir(git_repo)
+    assert get_remote_tips(["main"]) is None
+
+
+def test_find_moved_branches(git_repo, clone, monkeypatch):
+    branch = git(git_repo, "rev-parse", "--abbrev-ref", "HEAD")
+    head = git(git_repo, "rev-parse", "HEAD")
+    monkeypatch.chdir(clone)
+    last_commit = {branch: head, "feature/x": None, "nope": None, SHA_A: None}
+    # Branches origin lacks and fixed SHAs never count as moved
+    assert find_moved_branches(list(last_commit), last_commit) == ["feature/x"]
+
+
+def test_prepare_worktree_paths_do_not_collide(git_repo, tmp_path, monkeypatch):
+    head = git(git_repo, "rev-parse", "HEAD")
+    monkeypatch.chdir(git_repo)
+    worktree_dir = str(tmp_path / "worktrees")
+    first = prepare_worktree(worktree_dir, "a/b", head)
+    second = prepare_worktree(worktree_dir, "a_b", head)
+    assert first and second and first != second
+    # Reused on the next call rather than recreated
+    assert prepare_worktree(worktree_dir, "a/b", head) == first
+
+
+def test_checkout_commit_tracks_new_remote_branch(git_repo, clone, monkeypatch):
+    head = git(git_repo, "rev-parse", "HEAD")
+    monkeypatch.chdir(clone)
+    assert git_checkout_commit("feature/x", head)
+    assert git(clone, "rev-parse", "--abbrev-ref", "HEAD") == "feature/x"
+    assert git(clone, "rev-parse", "--abbrev-ref", "@{upstream}") == "origin/feature/x"
+
+
+def test_branch_commit_hashes_prefer_local(git_repo, clone, monkeypatch):
+    branch = git(git_repo, "rev-parse", "--abbrev-ref", "HEAD")
+    remote = git(git_repo, "rev-parse", "HEAD")
+    git(clone, "config", "user.email", "test@test.com")
+    git(clone, "config", "user.name", "Test User")
+    git(clone, "commit", "--allow-empty", "-m", "local only")
+    local = git(clone, "rev-parse", "HEAD")
+    monkeypatch.chdir(clone)
+    assert get_branch_commit_hashes([branch]) == {branch: remote}
+    assert get_branch_commit_hashes([branch], prefer_local=True) == {branch: local}
+
+
+@pytest.fixture
+def test_script(tmp_path):
+    """A test script that leaves a background child behind and sleeps."""
+    script = tmp_path / "test.sh"
+    script.write_text("#!/bin/sh\necho start\nsleep 30 &\necho $! > child.pid\nwait\n")
+    script.chmod(0o755)
+    return script
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # A zombie is dead, it is just waiting to be reaped
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def process_gone(pid, timeout=5):
+    deadline = time.monotonic() + timeout
+    while is_running(pid):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_run_tests_returns_exit_code(tmp_path, caplog):
+    script = tmp_path / "pass.sh"
+    script.write_text("#!/bin/sh\necho hello\nexit 3\n")
+    script.chmod(0o755)
+    with caplog.at_level(logging.INFO):
+        assert run_tests(str(script)) == 3
+    assert "[test] hello" in caplog.messages
+
+
+def test_run_tests_timeout_kills_process_group(tmp_path, test_script, caplog):
+    with caplog.at_level(logging.INFO):
+        assert run_tests(str(test_script), timeout=1, worktree_path=tmp_path) == 124
+    assert "[test] start" in caplog.messages
+    assert process_gone(int((tmp_path / "child.pid").read_text()))
+
+
+def test_run_tests_killed_on_exit_request(tmp_path, test_script):
+    timer = threading.Timer(1, main_legacy._EXIT.set)
+    timer.start()
+    try:
+        assert run_tests(str(test_script), worktree_path=tmp_path) != 0
+    finally:
+        timer.cancel()
+        main_legacy._EXIT.clear()
+    assert process_gone(int((tmp_path / "child.pid").read_text()))
+
+
+def test_branch_commit_hashes_exact_refnames_only(clone, monkeypatch):
+    # refs/remotes/origin/feature matches refs/remotes/origin/feature/x as a
+    # for-each-ref pattern, but "feature" is not a branch
+    monkeypatch.chdir(clone)
+    assert get_branch_commit_hashes(["feature"]) == {"feature": None}
+
+
+def test_branch_commit_hashes_falls_back_to_rev_parse(git_repo, clone, monkeypatch):
+    head = git(git_repo, "rev-parse", "HEAD")
+    git(clone, "tag", "v1")
+    monkeypatch.chdir(clone)
+    assert get_branch_commit_hashes(["v1", "nope"]) == {"v1": head, "nope": None}
+
+
+@pytest.mark.parametrize("from_disk", [True, False])
+def test_branch_commit_hashes_mixed(git_repo, clone, monkeypatch, from_disk):
+    branch = git(git_repo, "rev-parse", "--abbrev-ref", "HEAD")
+    head = git(git_repo, "rev-parse", "HEAD")
+    monkeypatch.chdir(clone)
+    if not from_disk:
+        # Send every lookup through git for-each-ref
+        monkeypatch.setattr(main_legacy, "find_git_dir", lambda _: None)
+    hashes = get_branch_commit_hashes([SHA_A.upper(), branch, "feature/x"])
+    assert hashes == {SHA_A.upper(): SHA_A, branch: head, "feature/x": head}
+
+
+@pytest.fixture
+def ref_handler(tmp_path):
+    """A RefChangeHandler for main and dev, plus its queue."""
+    branch_queue = queue.Queue()
+    handler = RefChangeHandler(str(tmp_path), ["main", "dev"], branch_queue)
+    yield handler, branch_queue
+    main_legacy._WAKE.clear()
+
+
+def test_ref_handler_lock_rename(tmp_path, ref_handler):
+    events = pytest.importorskip("watchdog.events")
+    handler, branch_queue = ref_handler
+    ref = tmp_path / "refs" / "heads" / "main"
+    handler.on_any_event(events.FileMovedEvent(f"{ref}.lock", str(ref)))
+    assert drain_branch_queue(branch_queue) == {"main"}
+    assert main_legacy._WAKE.is_set()
+
+
+def test_ref_handler_remote_ref(tmp_path, ref_handler):
+    events = pytest.importorskip("watchdog.events")
+    handler, branch_queue = ref_handler
+    ref = tmp_path / "refs" / "remotes" / "origin" / "dev"
+    handler.on_any_event(events.FileModifiedEvent(str(ref)))
+    assert drain_branch_queue(branch_queue) == {"dev"}
+
+
+def test_ref_handler_packed_refs_queues_every_branch(tmp_path, ref_handler):
+    events = pytest.importorskip("watchdog.events")
+    handler, branch_queue = ref_handler
+    packed = tmp_path / "packed-refs"
+    handler.on_any_event(events.FileMovedEvent(f"{packed}.lock", str(packed)))
+    assert drain_branch_queue(branch_queue) == {"main", "dev"}
+
+
+def test_ref_handler_ignores_other_events(tmp_path, ref_handler):
+    events = pytest.importorskip("watchdog.events")
+    handler, branch_queue = ref_handler
+    heads = tmp_path / "refs" / "heads"
+    # Our own reads fire opened/closed events; reacting to them would spin
+    handler.on_any_event(events.FileOpenedEvent(str(heads / "main")))
+    handler.on_any_event(events.FileClosedEvent(str(heads / "main")))
+    handler.on_any_event(events.FileModifiedEvent(str(heads / "other")))
+    handler.on_any_event(events.DirModifiedEvent(str(heads)))
+    assert drain_branch_queue(branch_queue) == set()
+    assert not main_legacy._WAKE.is_set()
+
+
+def test_post_webhook_message_logs_unexpected_errors(monkeypatch, caplog):
+    def boom(url, payload):
+        raise TypeError("not serializable")
+
+    monkeypatch.setattr(main_legacy, "send_webhook_message", boom)
+    with caplog.at_level(logging.ERROR):
+        future = post_webhook_message("http://example.invalid", {})
+        with pytest.raises(TypeError):
+            future.result(timeout=5)
+        # Callbacks run after waiters wake, so give the logging a moment
+        deadline = time.monotonic() + 5
+        while not caplog.records and time.monotonic() < deadline:
+            time.sleep(0.01)
+    assert "not serializable" in caplog.text